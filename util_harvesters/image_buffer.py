@@ -1,8 +1,16 @@
+import enum
+import queue
+import logging
 import itertools
 import datetime
+import threading
+import collections
+from typing import Callable, NamedTuple
 
+import numba
 import numpy as np
 
+from PyQt5 import sip
 from PyQt5.QtCore import pyqtSignal, QObject, QThread
 from PyQt5.QtGui import QImage
 
@@ -23,6 +31,8 @@ PATCHED_HARVESTERS = None
 if PATCHED_HARVESTERS:
     from harvesters.core import _is_logging_buffer_manipulation, _logger, _family_tree
 
+_log = logging.getLogger(__name__)
+
 SAVE_IMAGE_TO_FILE = False
 PRINT_PROGRESS = False
 
@@ -33,6 +43,56 @@ _VISIBLE_PAYLOADS = [
 ]
 
 
+class EnumFormatKind(enum.Enum):
+    MONO = enum.auto()
+    BAYER = enum.auto()
+    RGB = enum.auto()
+    BGR = enum.auto()
+
+
+class _Format(NamedTuple):
+    kind: EnumFormatKind
+    channels: int
+    # QImage reads the camera's channel order as it is: No swapping required
+    image_format: QImage.Format
+    # Right shift to 8 bits per channel
+    shift: int = 0
+
+
+_FORMAT_UNKNOWN = _Format(kind=None, channels=0, image_format=QImage.Format_Invalid)
+
+
+def _build_formats() -> dict:
+    "data_format -> _Format: One lookup per frame instead of probing every pfnc list"
+    formats = {}
+    for data_formats, format_ in (
+        (
+            mono_location_formats,
+            _Format(EnumFormatKind.MONO, 1, QImage.Format_Grayscale8),
+        ),
+        # Demosaiced to RGB
+        (
+            bayer_location_formats,
+            _Format(EnumFormatKind.BAYER, 1, QImage.Format_RGB888),
+        ),
+        (rgb_formats, _Format(EnumFormatKind.RGB, 3, QImage.Format_RGB888)),
+        # The alpha byte is ignored, like for BGRa: Cameras may leave it at 0
+        (rgba_formats, _Format(EnumFormatKind.RGB, 4, QImage.Format_RGBX8888)),
+        (bgr_formats, _Format(EnumFormatKind.BGR, 3, QImage.Format_BGR888)),
+        # 0xffRRGGBB is stored as B, G, R, A on little endian machines
+        (bgra_formats, _Format(EnumFormatKind.BGR, 4, QImage.Format_RGB32)),
+    ):
+        for data_format in data_formats:
+            bpp = get_bits_per_pixel(data_format)
+            if bpp is None:
+                continue
+            formats.setdefault(data_format, format_._replace(shift=max(0, bpp - 8)))
+    return formats
+
+
+_FORMATS = _build_formats()
+
+
 class _BufferPool:
     "Singleton required for cleaning up properly"
 
@@ -58,91 +118,344 @@ class _BufferPool:
 _BUFFER_BOOL = _BufferPool()
 
 
+class _FramePool:
+    "Recycles the arrays the frames are converted into"
+
+    def __init__(self, max_free: int = 2):
+        self._lock = threading.Lock()
+        self._max_free = max_free
+        self._free = {}
+
+    def acquire(self, shape: tuple, dtype=np.uint8) -> np.ndarray:
+        key = (shape, np.dtype(dtype))
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.popleft()
+        # QImage and glTexSubImage2D() expect packed rows
+        return np.empty(shape, dtype=dtype, order="C")
+
+    def release(self, array: np.ndarray) -> None:
+        key = (array.shape, array.dtype)
+        with self._lock:
+            free = self._free.setdefault(key, collections.deque())
+            if len(free) < self._max_free:
+                free.append(array)
+
+
+# Offset (x, y) which moves the red pixel of the bayer pattern to (0, 0)
+_BAYER_OFFSETS = {
+    "RG": (0, 0),
+    "GR": (1, 0),
+    "GB": (0, 1),
+    "BG": (1, 1),
+}
+
+
+def _bayer_pattern(data_format: str) -> str:
+    "'BayerRG12' -> 'RG'"
+    return data_format[len("Bayer") : len("Bayer") + 2]
+
+
+@numba.njit(cache=True)
+def _pixel(src: np.ndarray, y: int, x: int) -> int:
+    # Mirror at the border: Keeps the color of the bayer site
+    height, width = src.shape
+    if y < 0:
+        y = -y
+    elif y >= height:
+        y = 2 * (height - 1) - y
+    if x < 0:
+        x = -x
+    elif x >= width:
+        x = 2 * (width - 1) - x
+    return np.int32(src[y, x])
+
+
+# 'demosaic_malvar()' runs in a QThread: With the TBB threading layer, a parallel
+# kernel called from any thread but the main thread hangs the interpreter at exit.
+# 'workqueue' is always available, so 'tbb' is never chosen.
+numba.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+
+
+@numba.njit(parallel=True, cache=True)
+def demosaic_malvar(src: np.ndarray, dst: np.ndarray, offset_x: int, offset_y: int):
+    """Demosaic a bayer plane (height x width, uint8) into dst (height x width x 3, RGB, uint8).
+    Malvar-He-Cutler: High-quality linear interpolation for demosaicing of bayer-patterned color images.
+    The same kernels are used in the fragment shader of 'QHarvestersWidget'.
+    """
+    height, width = src.shape
+    for row in numba.prange(height):
+        y = np.int64(row)  # prange yields unsigned indices
+        for x in range(width):
+            c = _pixel(src, y, x)
+            row1 = _pixel(src, y, x - 1) + _pixel(src, y, x + 1)
+            col1 = _pixel(src, y - 1, x) + _pixel(src, y + 1, x)
+            row2 = _pixel(src, y, x - 2) + _pixel(src, y, x + 2)
+            col2 = _pixel(src, y - 2, x) + _pixel(src, y + 2, x)
+            diag = (
+                _pixel(src, y - 1, x - 1)
+                + _pixel(src, y - 1, x + 1)
+                + _pixel(src, y + 1, x - 1)
+                + _pixel(src, y + 1, x + 1)
+            )
+
+            # The kernels, scaled by 16
+            green = 8 * c + 4 * (row1 + col1) - 2 * (row2 + col2)
+            opposite = 12 * c + 4 * diag - 3 * (row2 + col2)
+            same_row = 10 * c + 8 * row1 - 2 * diag - 2 * row2 + col2
+            same_col = 10 * c + 8 * col1 - 2 * diag - 2 * col2 + row2
+
+            red_row = (y + offset_y) % 2 == 0
+            red_col = (x + offset_x) % 2 == 0
+            c16 = 16 * c
+            if red_row and red_col:
+                r, g, b = c16, green, opposite
+            elif not red_row and not red_col:
+                r, g, b = opposite, green, c16
+            elif red_row:
+                r, g, b = same_row, c16, same_col
+            else:
+                r, g, b = same_col, c16, same_row
+
+            dst[y, x, 0] = min(max((r + 8) // 16, 0), 255)
+            dst[y, x, 1] = min(max((g + 8) // 16, 0), 255)
+            dst[y, x, 2] = min(max((b + 8) // 16, 0), 255)
+
+
+def warm_up_demosaic() -> None:
+    "Compile 'demosaic_malvar()' before the first bayer frame is converted"
+    demosaic_malvar(
+        np.zeros((4, 4), dtype=np.uint8), np.empty((4, 4, 3), dtype=np.uint8), 0, 0
+    )
+
+
+class BayerImage(NamedTuple):
+    "The raw bayer plane, to be demosaiced by 'QHarvestersWidget.setBayer()'"
+
+    data: np.ndarray
+    width: int
+    height: int
+    pattern: str  # 'RG', 'GR', 'GB' or 'BG'
+
+
+# (component.data, acquire_frame) -> uint8 array
+_Converter = Callable[[np.ndarray, Callable[[tuple], np.ndarray]], np.ndarray]
+
+
+def _make_converters(
+    width: int, height: int, data_format: str, format_: _Format
+) -> tuple:
+    """Returns the converters (to_8bit, convert) specialized for one acquisition:
+    Per frame, no branches on the pixel format remain.
+    """
+    if format_.channels == 1:
+        shape = (height, width)
+    else:
+        shape = (height, width, format_.channels)
+    shift = format_.shift
+
+    if shift:
+
+        def to_8bit(data: np.ndarray, acquire_frame) -> np.ndarray:
+            # Shift the integer data down and narrow it to uint8 in a
+            # single pass: No float intermediate, no extra copy.
+            content_8bit = acquire_frame(shape)
+            np.right_shift(
+                data.reshape(shape), shift, out=content_8bit, casting="unsafe"
+            )
+            return content_8bit
+
+    else:
+
+        def to_8bit(data: np.ndarray, _acquire_frame) -> np.ndarray:
+            # Contiguous: Verified once by '_read_frame_layout()'
+            return data.reshape(shape)
+
+    if format_.kind is not EnumFormatKind.BAYER:
+        return to_8bit, to_8bit
+
+    shape_rgb = (height, width, 3)
+    offset_x, offset_y = _BAYER_OFFSETS[_bayer_pattern(data_format)]
+
+    def demosaic(data: np.ndarray, acquire_frame) -> np.ndarray:
+        content_rgb = acquire_frame(shape_rgb)
+        demosaic_malvar(to_8bit(data, acquire_frame), content_rgb, offset_x, offset_y)
+        return content_rgb
+
+    return to_8bit, demosaic
+
+
+class _FrameLayout(NamedTuple):
+    "Constant during an acquisition, so it is read once from the first buffer"
+
+    width: int
+    height: int
+    data_format: str
+    format_: _Format
+    # Of the converted array: Bayer is demosaiced to RGB
+    bytes_per_line: int
+    to_8bit: _Converter
+    convert: _Converter
+
+
+def _read_frame_layout(buffer: Buffer) -> _FrameLayout:
+    "Returns None if the buffer may not be displayed"
+    component = buffer.payload.components[0]
+    if is_custom(component.data_format_value):
+        return None
+    data_format = component.data_format
+    format_ = _FORMATS.get(data_format, _FORMAT_UNKNOWN)
+    if format_.kind is None:
+        return None
+    # The frames are handed to QImage without copying the rows
+    assert component.data.flags.c_contiguous
+    width, height = component.width, component.height
+    to_8bit, convert = _make_converters(width, height, data_format, format_)
+    channels = 3 if format_.kind is EnumFormatKind.BAYER else format_.channels
+    return _FrameLayout(
+        width=width,
+        height=height,
+        data_format=data_format,
+        format_=format_,
+        bytes_per_line=width * channels,
+        to_8bit=to_8bit,
+        convert=convert,
+    )
+
+
 class ImageBuffer:
-    def __init__(self, i: int, buffer: Buffer):
-        assert isinstance(i, int)
-        assert isinstance(buffer, Buffer)
-        assert buffer is not None
+    # One instance per frame: No '__dict__' required
+    __slots__ = ("_i", "_buffer", "_frame_pool", "_layout", "_frames", "_array")
+
+    def __init__(
+        self,
+        i: int,
+        buffer: Buffer,
+        frame_pool: _FramePool,
+        layout: _FrameLayout,
+    ):
         _BUFFER_BOOL.increment()
         self._i = i
         self._buffer = buffer
+        self._frame_pool = frame_pool
+        self._layout = layout
+        self._frames = []
+        self._array = None
 
     def release(self) -> None:
         _BUFFER_BOOL.decrement()
         self._buffer.queue()
         self._buffer = None
+        self._array = None
+        for frame in self._frames:
+            self._frame_pool.release(frame)
+        self._frames = []
+
+    def _acquire_frame(self, shape: tuple) -> np.ndarray:
+        frame = self._frame_pool.acquire(shape)
+        self._frames.append(frame)
+        return frame
 
     @property
     def i(self) -> int:
         return self._i
 
     @property
-    def image(self) -> QImage:
-        #
-        payload = self._buffer.payload
-        component = payload.components[0]
-        width = component.width
-        height = component.height
-
-        #
-        exponent = 0
-        data_format = None
-
-        #
-        data_format_value = component.data_format_value
-        if is_custom(data_format_value):
-            return
+    def bayer(self) -> BayerImage:
+        "Returns the raw bayer plane or None if this is not a bayer format"
+        layout = self._layout
+        if layout is None or layout.format_.kind is not EnumFormatKind.BAYER:
+            return None
+        data = self._buffer.payload.components[0].data
+        content = layout.to_8bit(data, self._acquire_frame)
+        return BayerImage(
+            data=content,
+            width=layout.width,
+            height=layout.height,
+            pattern=_bayer_pattern(layout.data_format),
+        )
 
-        data_format = component.data_format
-        bpp = get_bits_per_pixel(data_format)
-        if bpp is None:
+    @property
+    def array(self) -> np.ndarray:
+        """Returns the frame as contiguous uint8 array: height x width for mono,
+        height x width x channels in the camera's channel order otherwise, see 'image_format'.
+        The array is only valid until 'release()'.
+        """
+        if self._array is None:
+            self.convert()
+        return self._array
+
+    def convert(self) -> None:
+        """Converts the frame into 'array'.
+        Called by the acquisition thread, so the GUI thread only has to wrap the array.
+        """
+        if self._layout is None:
             return
-        exponent = bpp - 8
-
-        # Reshape the image so that it can be drawn on the
-        # VisPy canvas:
-        if (
-            data_format in mono_location_formats
-            or data_format in bayer_location_formats
-        ):
-            # Reshape the 1D NumPy array into a 2D so that VisPy
-            # can display it as a mono image:
-            content = component.data.reshape(height, width)
-        else:
-            # The image requires you to reshape it to draw it on the
-            # canvas:
-            if (
-                data_format in rgb_formats
-                or data_format in rgba_formats
-                or data_format in bgr_formats
-                or data_format in bgra_formats
-            ):
-                # Reshape the 1D NumPy array into a 2D so that VisPy
-                # can display it as an RGB image:
-                content = component.data.reshape(
-                    height,
-                    width,
-                    int(component.num_components_per_pixel),
-                )
-                #
-                if data_format in bgr_formats:
-                    # Swap every R and B so that VisPy can display
-                    # it as an RGB image:
-                    content = content[:, :, ::-1]
-            else:
-                return
+        data = self._buffer.payload.components[0].data
+        self._array = self._layout.convert(data, self._acquire_frame)
+
+    @property
+    def image_format(self) -> QImage.Format:
+        "The QImage format matching the channel order of 'array'"
+        if self._layout is None:
+            return QImage.Format_Invalid
+        return self._layout.format_.image_format
 
-        # Convert each data to an 8bit.
-        if exponent > 0:
-            # The following code may affect to the rendering
-            # performance:
-            content = content / (2**exponent)
+    @property
+    def image(self) -> QImage:
+        """Returns a QImage referencing 'array' without copying it.
+        'array' is kept alive by this object, but the QImage is only valid
+        until 'release()': Any 'QImage.copy()' or 'QPixmap.fromImage()' has to happen before.
+        """
+        content = self.array
+        if content is None:
+            return None
+
+        # Everything but the pixels is known since the first frame
+        layout = self._layout
+        return QImage(
+            sip.voidptr(content.ctypes.data),
+            layout.width,
+            layout.height,
+            layout.bytes_per_line,
+            layout.format_.image_format,
+        )
+
+
+class _ImageConverterThread(QThread):
+    """Converts the buffers fetched by 'ImageReaderThread' and emits them.
+    Meanwhile 'ImageReaderThread' already waits for the next buffer.
+    """
+
+    def __init__(self, parent: QObject, image_acquired):
+        super().__init__(parent=parent)
+        self._image_acquired = image_acquired
+        self._queue = queue.Queue(maxsize=2)
 
-            # Then cast each array element to an uint8:
-            content = content.astype(np.uint8)
+    def put(self, image_buffer: ImageBuffer) -> None:
+        self._queue.put(image_buffer)
 
-        height2, width2, _ = content.shape
-        return QImage(content.data, width2, height2, 3 * width2, QImage.Format_RGB888)
+    def stop(self) -> None:
+        "Returns after all buffers put so far have been emitted"
+        self._queue.put(None)
+        self.wait()
+
+    def run(self):
+        while True:
+            image_buffer = self._queue.get()
+            if image_buffer is None:
+                break
+            try:
+                image_buffer.convert()
+                self._image_acquired.emit(image_buffer)
+            except Exception:  # pylint: disable=broad-except
+                # Keep draining: 'ImageReaderThread' would block in 'put()' forever
+                _log.exception(f"Dropping frame {image_buffer.i}")
+                image_buffer.release()
+                continue
+            if PRINT_PROGRESS:
+                print(f"Progress {image_buffer.i}: B", flush=True)
 
 
 class ImageReaderThread(QThread):
@@ -156,26 +469,45 @@ class ImageReaderThread(QThread):
         self._stop_acquisition = False
         self._ia = ia
         self._frame_per_s = frame_pre_s
+        self._frame_pool = _FramePool()
+        self._format_label = None
+        self._layout = None
         _BUFFER_BOOL.reset()
         super().__init__(parent=parent)
+        self._converter = _ImageConverterThread(
+            parent=self, image_acquired=self.image_acquired
+        )
 
     def stop_acquisition(self):
         self._stop_acquisition = True
 
     def run(self):
         """Long-running task."""
+        self._converter.start()
+
         # https://github.com/genicam/harvesters
         self._ia.start_acquisition(run_in_background=False)
 
+        # Width, height and pixel format are locked while acquiring:
+        # Read them once, every node map access is a round trip to the camera.
+        node_map = self._ia.remote_device.node_map
+        self._format_label = " ".join(
+            [
+                f"{node_map.Width.value}x{node_map.Height.value}",
+                node_map.PixelFormat.value,
+            ]
+        )
+
         event_manager = self._ia._event_new_buffer_managers[
             0
         ]  # pylint: disable=protected-access
         # RATIONALE
-        # 'event_manager.update_event_data()' seems to consume a lot of cpu.
-        # So we try to remain as short as possible.
-        # The rest of the time we remain in 'self.msleep()'
-        timeout_after_image_acquistion_ms = int(1000.0 * 0.9 / self._frame_per_s)
-        timeout_for_image_acquisition_ms = int(1000.0 * 0.2 / self._frame_per_s)
+        # 'event_manager.update_event_data()' blocks in GenTL till the next buffer arrives.
+        # 'ImageAcquirer.fetch_buffer()' would poll it every
+        # 'timeout_for_image_acquisition' (1ms) instead.
+        # The frame rate is paced by the camera ('AcquisitionFrameRate'),
+        # sleeping in here would only add latency.
+        timeout_acquisition_ms = int(1000.0 * 2.0 / self._frame_per_s)
         for i in itertools.count():
             if not self._ia.is_acquiring():
                 break
@@ -185,71 +517,81 @@ class ImageReaderThread(QThread):
                     self._ia.stop_acquisition()
                 break
 
-            def handle_one_buffer(i: int):
-                try:
-                    self.msleep(timeout_after_image_acquistion_ms)
-                    event_manager.update_event_data(timeout_for_image_acquisition_ms)
-                except TimeoutException:
-                    if PATCHED_HARVESTERS:
-                        _logger.info("TimeoutException")
-                    return
-                genicam_buffer = event_manager.buffer
-
-                def queue_buffer(msg: str):
-                    if PATCHED_HARVESTERS:
-                        _logger.info(f"Discard buffer: {msg}")
-                    genicam_buffer.parent.queue_buffer(genicam_buffer)
-
-                if not genicam_buffer.is_complete():
-                    queue_buffer("The acquired buffer was incomplete")
-                    return
-                if genicam_buffer.payload_type not in _VISIBLE_PAYLOADS:
-                    queue_buffer("Buffer not visible")
-                    return
-                if self._stop_acquisition:
-                    queue_buffer("Stopping acquisition")
-                    return
-
-                if PATCHED_HARVESTERS:
-                    if _is_logging_buffer_manipulation:
-                        _logger.debug(
-                            f"{self} has fetched buffer {genicam_buffer.context}"
-                            f" containing frame {genicam_buffer.frame_id}"
-                            f" from {_family_tree(event_manager.parent)}"
-                        )
-
-                buffer = Buffer(
-                    buffer=genicam_buffer, node_map=self._ia.remote_device.node_map
-                )
-                if PRINT_PROGRESS:
-                    print(f"Progress {i}: A", flush=True)
-
-                self._update_statistics(buffer=buffer)
-                self.image_acquired.emit(ImageBuffer(i=i, buffer=buffer))
-                if PRINT_PROGRESS:
-                    print(f"Progress {i}: B", flush=True)
-
-            handle_one_buffer(i)
+            self._handle_one_buffer(i, event_manager, timeout_acquisition_ms)
 
+        self._converter.stop()
         self._ia.destroy()
         self._ia = None
 
         self.done.emit()
 
+    def _requeue(self, genicam_buffer, msg: str) -> None:
+        if PATCHED_HARVESTERS:
+            _logger.info(f"Discard buffer: {msg}")
+        genicam_buffer.parent.queue_buffer(genicam_buffer)
+
     def _update_statistics(self, buffer) -> None:
         assert buffer
         self._ia.statistics.increment_num_images()
         self._ia.statistics.update_timestamp(buffer)
 
+    def _handle_one_buffer(
+        self, i: int, event_manager, timeout_acquisition_ms: int
+    ) -> None:
+        try:
+            event_manager.update_event_data(timeout_acquisition_ms)
+        except TimeoutException:
+            if PATCHED_HARVESTERS:
+                _logger.info("TimeoutException")
+            return
+        genicam_buffer = event_manager.buffer
+
+        if not genicam_buffer.is_complete():
+            self._requeue(genicam_buffer, "The acquired buffer was incomplete")
+            return
+        if genicam_buffer.payload_type not in _VISIBLE_PAYLOADS:
+            self._requeue(genicam_buffer, "Buffer not visible")
+            return
+        if self._stop_acquisition:
+            self._requeue(genicam_buffer, "Stopping acquisition")
+            return
+
+        if PATCHED_HARVESTERS:
+            if _is_logging_buffer_manipulation:
+                _logger.debug(
+                    f"{self} has fetched buffer {genicam_buffer.context}"
+                    f" containing frame {genicam_buffer.frame_id}"
+                    f" from {_family_tree(event_manager.parent)}"
+                )
+
+        if PRINT_PROGRESS:
+            print(f"Progress {i}: A", flush=True)
+
+        # Only buffers which are displayed: Saves building payload and components
+        buffer = Buffer(buffer=genicam_buffer, node_map=self._ia.remote_device.node_map)
+        self._update_statistics(buffer=genicam_buffer)
+        if self._layout is None:
+            self._layout = _read_frame_layout(buffer)
+            if (
+                self._layout is not None
+                and self._layout.format_.kind is EnumFormatKind.BAYER
+            ):
+                warm_up_demosaic()
+        self._converter.put(
+            ImageBuffer(
+                i=i, buffer=buffer, frame_pool=self._frame_pool, layout=self._layout
+            )
+        )
+
     @property
     def statistics(self) -> str:
         if self._ia is None:
             return "stopped"
-        node_map = self._ia.remote_device.node_map
+        if self._format_label is None:
+            return "starting"
         elapsed = datetime.timedelta(seconds=int(self._ia.statistics.elapsed_time_s))
         list_labels = [
-            f"{node_map.Width.value}x{node_map.Height.value}",
-            node_map.PixelFormat.value,
+            self._format_label,
             f"{self._ia.statistics.fps:.1f} fps",
             f"elapsed {elapsed}",
             f"{self._ia.statistics.num_images} images",
@@ -7,11 +7,14 @@ from PyQt5.QtGui import (
     QColor,
     QImage,
     QMatrix4x4,
+    QOpenGLBuffer,
     QOpenGLShader,
+    QOpenGLPixelTransferOptions,
     QOpenGLShaderProgram,
     QOpenGLTexture,
     QOpenGLVersionProfile,
     QSurfaceFormat,
+    QVector2D,
 )
 from PyQt5.QtWidgets import QApplication, QGridLayout, QOpenGLWidget, QWidget
 
@@ -42,12 +45,80 @@ _FRAGMENT_SHADER = """
 
 varying vec2 v_texcoord;
 uniform sampler2D u_texture;
+
+// Bayer demosaicing (Malvar-He-Cutler), only if u_bayer is set
+uniform int u_bayer;
+uniform vec2 u_bayer_offset; // moves the red pixel to (0, 0)
+uniform vec2 u_texture_size;
+
+float fetch(vec2 p, float dx, float dy)
+{
+    return texture2D(u_texture, (p + vec2(dx, dy) + 0.5) / u_texture_size).r;
+}
+
+vec3 demosaic(vec2 p)
+{
+    float c = fetch(p, 0.0, 0.0);
+    float cross1 = fetch(p, -1.0, 0.0) + fetch(p, 1.0, 0.0) + fetch(p, 0.0, -1.0) + fetch(p, 0.0, 1.0);
+    float row1 = fetch(p, -1.0, 0.0) + fetch(p, 1.0, 0.0);
+    float col1 = fetch(p, 0.0, -1.0) + fetch(p, 0.0, 1.0);
+    float row2 = fetch(p, -2.0, 0.0) + fetch(p, 2.0, 0.0);
+    float col2 = fetch(p, 0.0, -2.0) + fetch(p, 0.0, 2.0);
+    float diag = fetch(p, -1.0, -1.0) + fetch(p, 1.0, -1.0) + fetch(p, -1.0, 1.0) + fetch(p, 1.0, 1.0);
+
+    // Green at a red or blue pixel
+    float green = (4.0 * c + 2.0 * cross1 - row2 - col2) / 8.0;
+    // Red at a blue pixel or blue at a red pixel
+    float opposite = (6.0 * c + 2.0 * diag - 1.5 * (row2 + col2)) / 8.0;
+    // At a green pixel: The color of the same row / the same column
+    float same_row = (5.0 * c + 4.0 * row1 - diag - row2 + 0.5 * col2) / 8.0;
+    float same_col = (5.0 * c + 4.0 * col1 - diag - col2 + 0.5 * row2) / 8.0;
+
+    vec2 site = mod(p + u_bayer_offset, 2.0);
+    if (site.x < 0.5 && site.y < 0.5) {
+        return vec3(c, green, opposite);  // red pixel
+    }
+    if (site.x > 0.5 && site.y > 0.5) {
+        return vec3(opposite, green, c);  // blue pixel
+    }
+    if (site.y < 0.5) {
+        return vec3(same_row, c, same_col);  // green pixel in a red row
+    }
+    return vec3(same_col, c, same_row);  // green pixel in a blue row
+}
+
 void main()
 {
+    if (u_bayer != 0) {
+        vec2 p = floor(v_texcoord * u_texture_size);
+        gl_FragColor = vec4(clamp(demosaic(p), 0.0, 1.0), 1.0);
+        return;
+    }
     gl_FragColor = texture2D(u_texture, v_texcoord);
 }
 """
 
+# Pixel formats accepted by 'setData()' and the texture format to store them
+_DATA_TEXTURE_FORMATS = {
+    QOpenGLTexture.Luminance: QOpenGLTexture.LuminanceFormat,
+    QOpenGLTexture.RGB: QOpenGLTexture.RGB8_UNorm,
+    QOpenGLTexture.RGBA: QOpenGLTexture.RGBA8_UNorm,
+    QOpenGLTexture.BGR: QOpenGLTexture.RGB8_UNorm,
+    QOpenGLTexture.BGRA: QOpenGLTexture.RGBA8_UNorm,
+}
+
+# Pixel buffer objects 'setData()' cycles through: While the GPU still
+# reads one of them, the next frame is already written to another one.
+_PIXEL_BUFFER_COUNT = 3
+
+# Offset which moves the red pixel of the bayer pattern to (0, 0)
+_BAYER_OFFSETS = {
+    "RG": QVector2D(0.0, 0.0),
+    "GR": QVector2D(1.0, 0.0),
+    "GB": QVector2D(0.0, 1.0),
+    "BG": QVector2D(1.0, 1.0),
+}
+
 
 class QHarvestersWidget(QOpenGLWidget):
 
@@ -85,6 +156,13 @@ class QHarvestersWidget(QOpenGLWidget):
         def __init__(self, program: QOpenGLShaderProgram):
             self.u_projection = QHarvestersWidget.UniformValue(program, "u_projection")
             self.u_texture = QHarvestersWidget.UniformValue(program, "u_texture")
+            self.u_bayer = QHarvestersWidget.UniformValue(program, "u_bayer")
+            self.u_bayer_offset = QHarvestersWidget.UniformValue(
+                program, "u_bayer_offset"
+            )
+            self.u_texture_size = QHarvestersWidget.UniformValue(
+                program, "u_texture_size"
+            )
             self.a_texcoord = QHarvestersWidget.AttributeArray(program, "a_texcoord")
             self.a_position = QHarvestersWidget.AttributeArray(program, "a_position")
 
@@ -102,10 +180,16 @@ class QHarvestersWidget(QOpenGLWidget):
         self._origin = [0, 0]
         self._dirty = True
         self._image = QImage(100, 100, QImage.Format_Indexed8)
+        self._bayer = None
+        self._bayer_pattern = None
+        self._data = None
 
         self._width, self._height = 100, 100
 
         self._texture: QOpenGLTexture = None
+        self._texture_key: tuple = None
+        self._pixel_buffers: list = None
+        self._pixel_buffer_index = 0
 
     def minimumSizeHint(self):
         return QSize(50, 50)
@@ -119,9 +203,40 @@ class QHarvestersWidget(QOpenGLWidget):
 
     def setImage(self, image):
         self._image = image
+        self._bayer = None
+        self._data = None
+        self.update()
+
+    def setBayer(self, width: int, height: int, pattern: str, data):
+        """Display a raw bayer plane (uint8, height x width).
+        The demosaicing is done by the fragment shader.
+        :param pattern: 'RG', 'GR', 'GB' or 'BG'
+        """
+        assert pattern in _BAYER_OFFSETS
+        self._bayer = (width, height, pattern, data)
+        self._image = None
+        self._data = None
+        if self.isValid():
+            self._upload_now(self._upload_bayer)
+        else:
+            # No GL context before the widget is shown: Keep a copy till 'paintGL()'
+            self._bayer = (width, height, pattern, memoryview(data).tobytes())
         self.update()
 
     def setData(self, width: int, height: int, format, data: bytes):
+        """Display uint8 pixels without wrapping them into a QImage.
+        'data' is uploaded by 'glTexSubImage2D()' before returning.
+        :param format: QOpenGLTexture.Luminance, .RGB, .RGBA, .BGR or .BGRA (camera order)
+        """
+        assert format in _DATA_TEXTURE_FORMATS
+        self._data = (width, height, format, data)
+        self._image = None
+        self._bayer = None
+        if self.isValid():
+            self._upload_now(self._upload_frame_data)
+        else:
+            # No GL context before the widget is shown: Keep a copy till 'paintGL()'
+            self._data = (width, height, format, memoryview(data).tobytes())
         self.update()
 
     def initializeGL(self):
@@ -133,6 +248,13 @@ class QHarvestersWidget(QOpenGLWidget):
         self._gl.glDepthFunc(self._gl.GL_LESS)
         self._gl.glEnable(self._gl.GL_CULL_FACE)
 
+        self._pixel_buffers = []
+        for _ in range(_PIXEL_BUFFER_COUNT):
+            pixel_buffer = QOpenGLBuffer(QOpenGLBuffer.PixelUnpackBuffer)
+            pixel_buffer.create()
+            pixel_buffer.setUsagePattern(QOpenGLBuffer.StreamDraw)
+            self._pixel_buffers.append(pixel_buffer)
+
         vshader = QOpenGLShader(QOpenGLShader.Vertex, self)
         vshader.compileSourceCode(_VERTEX_SHADER)
         print(f"vshader.log='{vshader.log()}'")
@@ -171,57 +293,131 @@ class QHarvestersWidget(QOpenGLWidget):
         self._gl.glClear(self._gl.GL_COLOR_BUFFER_BIT | self._gl.GL_DEPTH_BUFFER_BIT)
 
         if self._image is not None:
-            self._width, self._height = self._image.width(), self._image.height()
-
-            if False:
-                if self._texture_format != self._image.format():
-                    if self._texture is not None:
-                        print("Distroyed texture as the image format changed")
-                        self._texture.destroy()
-                        del self._texture
-                        self._texture = None
-
-                if self._texture is None:
-                    print(
-                        f"{self._image.format()} {self._image.isDetached()} {self._image.colorCount()} {self._image.sizeInBytes()} {self._image.width()}/{self._image.height()}"
-                    )
-                    self._texture = QOpenGLTexture(self._image)
-                    self._texture.setMinificationFilter(
-                        QOpenGLTexture.LinearMipMapLinear
-                    )
-                    self._texture.setMagnificationFilter(QOpenGLTexture.Linear)
-                else:
-                    print(
-                        f"{self._image.format()} {self._image.isDetached()} {self._image.colorCount()} {self._image.sizeInBytes()} {self._image.width()}/{self._image.height()}"
-                    )
-                    print("vvvvvvvvvvvv")
-                    self._texture.setData(
-                        self._image, QOpenGLTexture.DontGenerateMipMaps
-                    )
-                    print("^^^^^^^^^^^^")
-                self._texture_format = self._image.format()
-            if True:
-                if self._texture is not None:
-                    # self._texture.destroy()
-                    del self._texture
-                self._texture = QOpenGLTexture(self._image)
-                self._texture.setMinificationFilter(QOpenGLTexture.LinearMipMapLinear)
+            key = ("image", self._image.width(), self._image.height())
+            if self._reuse_texture(key):
+                # 'setData(QImage)' would set format, size and mip levels again,
+                # which is refused once the storage exists.
+                # QOpenGLTexture(QImage) stores RGBA8: Upload the same layout.
+                rgba = self._image.convertToFormat(QImage.Format_RGBA8888)
+                self._texture.setData(
+                    QOpenGLTexture.RGBA, QOpenGLTexture.UInt8, rgba.constBits()
+                )
+            else:
+                self._texture = QOpenGLTexture(
+                    self._image, QOpenGLTexture.DontGenerateMipMaps
+                )
+                # No mipmaps: They would have to be rebuilt for every frame
+                self._texture.setMinificationFilter(QOpenGLTexture.Linear)
                 self._texture.setMagnificationFilter(QOpenGLTexture.Linear)
 
             self._image = None
-            self._dirty = True
+            self._bayer_pattern = None
+
+        self._upload_bayer()
+
+        self._upload_frame_data()
 
         if self._texture is None:
             return
 
         self._program.bind()
         self._recalc_projection()
+        self._values.u_bayer.set(int(self._bayer_pattern is not None))
+        if self._bayer_pattern is not None:
+            self._values.u_bayer_offset.set(_BAYER_OFFSETS[self._bayer_pattern])
+            self._values.u_texture_size.set(QVector2D(self._width, self._height))
 
         self._texture.bind()
         self._gl.glDrawArrays(self._gl.GL_TRIANGLE_STRIP, 0, 4)
         self._texture.release()
         self._program.release()
 
+    def _upload_now(self, upload) -> None:
+        """Uploads the frame before the setter returns.
+        The arrays of 'ImageBuffer' are reused after 'ImageBuffer.release()',
+        which is called long before the next 'paintGL()'.
+        """
+        self.makeCurrent()
+        upload()
+        self.doneCurrent()
+
+    def _upload_bayer(self) -> None:
+        if self._bayer is None:
+            return
+        width, height, self._bayer_pattern, data = self._bayer
+        key = ("bayer", width, height)
+        if not self._reuse_texture(key):
+            self._texture = QOpenGLTexture(QOpenGLTexture.Target2D)
+            self._texture.setFormat(QOpenGLTexture.R8_UNorm)
+            self._texture.setSize(width, height)
+            # The shader picks the neighbours itself, no interpolation
+            self._texture.setMinificationFilter(QOpenGLTexture.Nearest)
+            self._texture.setMagnificationFilter(QOpenGLTexture.Nearest)
+            self._texture.allocateStorage(QOpenGLTexture.Red, QOpenGLTexture.UInt8)
+        options = QOpenGLPixelTransferOptions()
+        options.setAlignment(1)
+        self._texture.setData(QOpenGLTexture.Red, QOpenGLTexture.UInt8, data, options)
+
+        self._bayer = None
+
+    def _upload_frame_data(self) -> None:
+        if self._data is None:
+            return
+        width, height, pixel_format, data = self._data
+        key = ("data", width, height, pixel_format)
+        if not self._reuse_texture(key):
+            self._texture = QOpenGLTexture(QOpenGLTexture.Target2D)
+            self._texture.setFormat(_DATA_TEXTURE_FORMATS[pixel_format])
+            self._texture.setSize(width, height)
+            self._texture.setMinificationFilter(QOpenGLTexture.Linear)
+            self._texture.setMagnificationFilter(QOpenGLTexture.Linear)
+            self._texture.allocateStorage(pixel_format, QOpenGLTexture.UInt8)
+        self._upload_data(pixel_format, data)
+
+        self._data = None
+        self._bayer_pattern = None
+
+    def _upload_data(self, pixel_format, data) -> None:
+        """Copies 'data' into the next pixel buffer object and lets the driver
+        stream it from there into the texture, asynchronous to the draw calls.
+        """
+        pixel_buffer = self._pixel_buffers[self._pixel_buffer_index]
+        self._pixel_buffer_index = (self._pixel_buffer_index + 1) % len(
+            self._pixel_buffers
+        )
+
+        pixels = memoryview(data).cast("B")
+        pixel_buffer.bind()
+        # Orphan the previous storage: The GPU may still read it, 'map()' won't wait
+        pixel_buffer.allocate(pixels.nbytes)
+        mapped = pixel_buffer.map(QOpenGLBuffer.WriteOnly)
+        mapped.setsize(pixels.nbytes)
+        mapped.setwriteable(True)
+        memoryview(mapped)[:] = pixels
+        pixel_buffer.unmap()
+
+        options = QOpenGLPixelTransferOptions()
+        # Rows of 'Luminance' or 'RGB' pixels are not padded to 4 bytes
+        options.setAlignment(1)
+        # A bound pixel buffer turns the pointer into an offset into the buffer
+        self._texture.setData(pixel_format, QOpenGLTexture.UInt8, None, options)
+        # Unbind: The other uploads read from client memory
+        pixel_buffer.release()
+
+    def _reuse_texture(self, key: tuple) -> bool:
+        """Returns True if the current texture may be overwritten with the new frame.
+        Otherwise the texture is destroyed and has to be recreated by the caller.
+        """
+        if self._texture is not None and key == self._texture_key:
+            return True
+        if self._texture is not None:
+            self._texture.destroy()
+            self._texture = None
+        _kind, self._width, self._height = key[:3]
+        self._texture_key = key
+        self._dirty = True
+        return False
+
     def _recalc_projection(self):
         if not self._dirty:
             return
@@ -4,9 +4,10 @@
 import sys
 import random
 import pathlib
+import collections
 
-from PyQt5.QtCore import Qt, QRectF, pyqtSignal, QTimer
-from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import Qt, QPointF, QRectF, QRunnable, QThreadPool, pyqtSignal, QTimer
+from PyQt5.QtGui import QImage, QImageReader, QPainter, QPixmap, QTransform
 from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QFileDialog, QApplication
 
 __author__ = "Marcel Goldschen-Ohm <marcel.goldschen@gmail.com>"
@@ -19,7 +20,99 @@ __version__ = "0.9.0"
 #   Qt.KeepAspectRatioByExpanding: Scale image to fill the viewport, preserving aspect ratio.
 _ASPECT_RATIO_MODE = Qt.KeepAspectRatio
 
-_ZOOM_FACTOR = 1.25
+# Zoom per wheel step, indexed by 'wheel turned up'.
+_ZOOM_UP = 1.25
+_ZOOM_DN = 1 / _ZOOM_UP
+_ZOOMS = (_ZOOM_DN, _ZOOM_UP)
+
+# Mouse buttons the viewer reacts on, other buttons are passed on unchanged.
+_HANDLED_BUTTONS = (Qt.LeftButton, Qt.RightButton)
+
+# Smooth pixmap scaling is enabled after this idle time following a zoom or pan.
+_SMOOTH_DELAY_MS = 150
+
+# Images covering more than this multiple of the viewport area are downsampled
+# to _PREVIEW_HEADROOM times the viewport size (headroom for zooming) before being shown.
+_DOWNSAMPLE_AREA_RATIO = 4
+_PREVIEW_HEADROOM = 2
+
+# Number of QPixmaps converted from QImages which are kept for reuse.
+_PIXMAP_CACHE_SIZE = 8
+
+# Number of QPixmaps decoded from files which are kept for reuse.
+# Not shared with the converted QImages: A camera stream would evict them at once.
+_FILE_CACHE_SIZE = 16
+
+
+# type(image) -> function(viewer, image) returning a QPixmap.
+_IMG_TO_PIXMAP = {
+    QPixmap: lambda viewer, pixmap: pixmap,
+    QImage: lambda viewer, image: viewer._to_pixmap(image),
+}
+
+
+# QPixmap.fromImage() converts any other format pixel by pixel.
+_PIXMAP_FORMATS = (QImage.Format_ARGB32_Premultiplied, QImage.Format_RGB32)
+_NO_CONVERSION = Qt.NoFormatConversion | Qt.NoOpaqueDetection
+
+
+def _image_to_pixmap(image: QImage, pixmap: QPixmap = None) -> QPixmap:
+    """Convert in one pass, without fromImage() scanning the image for opaqueness.
+    If 'pixmap' has the size of the image, it is overwritten instead of allocating a new QPixmap.
+    """
+    if image.format() in _PIXMAP_FORMATS:
+        # fromImage() would share the pixels instead of copying them: The image may wrap
+        # a buffer which is reused after 'ImageBuffer.release()'.
+        image = image.copy()
+    elif image.hasAlphaChannel():
+        image = image.convertToFormat(
+            QImage.Format_ARGB32_Premultiplied, _NO_CONVERSION
+        )
+    else:
+        # Forces alpha to 0xff: 'Format_RGBX8888' frames may carry 0 in the X byte
+        image = image.convertToFormat(QImage.Format_RGB32, _NO_CONVERSION)
+    if pixmap is None or pixmap.size() != image.size():
+        return QPixmap.fromImage(image, _NO_CONVERSION)
+    pixmap.convertFromImage(image, _NO_CONVERSION)
+    return pixmap
+
+
+def _lru_get(cache: collections.OrderedDict, key) -> QPixmap:
+    """Returns the cached pixmap or None and marks it as recently used."""
+    pixmap = cache.get(key)
+    if pixmap is not None:
+        cache.move_to_end(key)
+    return pixmap
+
+
+def _lru_put(
+    cache: collections.OrderedDict, key, pixmap: QPixmap, size: int
+) -> QPixmap:
+    """Caches the pixmap. Returns the least recently used pixmap if it was evicted."""
+    cache[key] = pixmap
+    if len(cache) > size:
+        _key, evicted = cache.popitem(last=False)
+        return evicted
+    return None
+
+
+class _ImageLoader(QRunnable):
+    """Decodes an image file in a thread of the QThreadPool.
+    QImage may be decoded in any thread, a QPixmap only in the GUI thread.
+    """
+
+    def __init__(self, filename: str, loaded):
+        super().__init__()
+        self._filename = filename
+        self._loaded = loaded
+
+    def run(self):
+        # One reader: Checks the header first and decodes only a readable image.
+        reader = QImageReader(self._filename)
+        reader.setDecideFormatFromContent(True)
+        image = reader.read() if reader.canRead() else QImage()
+        # Also emitted for unreadable files: The filename is not pending anymore.
+        self._loaded.emit(self._filename, image)
 
 
 class QtImageViewer(QGraphicsView):
@@ -38,14 +131,17 @@ class QtImageViewer(QGraphicsView):
         Right mouse button doubleclick: Zoom to show entire image.
     """
 
-    # Mouse button signals emit image scene (x, y) coordinates.
+    # Mouse button signals emit the image scene position as QPointF.
     # !!! For image (row, column) matrix indexing, row = y and column = x.
-    leftMouseButtonPressed = pyqtSignal(float, float)
-    rightMouseButtonPressed = pyqtSignal(float, float)
-    leftMouseButtonReleased = pyqtSignal(float, float)
-    rightMouseButtonReleased = pyqtSignal(float, float)
-    leftMouseButtonDoubleClicked = pyqtSignal(float, float)
-    rightMouseButtonDoubleClicked = pyqtSignal(float, float)
+    leftMouseButtonPressed = pyqtSignal(QPointF)
+    rightMouseButtonPressed = pyqtSignal(QPointF)
+    leftMouseButtonReleased = pyqtSignal(QPointF)
+    rightMouseButtonReleased = pyqtSignal(QPointF)
+    leftMouseButtonDoubleClicked = pyqtSignal(QPointF)
+    rightMouseButtonDoubleClicked = pyqtSignal(QPointF)
+
+    # Emitted from the QThreadPool, received in the GUI thread.
+    _imagePreloaded = pyqtSignal(str, QImage)
 
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -70,6 +166,50 @@ class QtImageViewer(QGraphicsView):
 
         self._is_zooming = False
 
+        # View transform, zoom steps are composed here before being applied.
+        self._xform = QTransform()
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+
+        # Wheel steps since the last scale(): Applied once per event loop iteration.
+        self._pending_zoom = 1.0
+        self._zoom_timer = QTimer(self)
+        self._zoom_timer.setSingleShot(True)
+        self._zoom_timer.setInterval(0)
+        self._zoom_timer.timeout.connect(self._flush_zoom)
+
+        # Nearest neighbor scaling while zooming and panning, smooth scaling when idle.
+        self._smooth = True
+        self.setRenderHint(QPainter.SmoothPixmapTransform, True)
+        self._smooth_timer = QTimer(self)
+        self._smooth_timer.setSingleShot(True)
+        self._smooth_timer.setInterval(_SMOOTH_DELAY_MS)
+        self._smooth_timer.timeout.connect(lambda: self._set_smooth(True))
+
+        # QImage.cacheKey() -> QPixmap, least recently used first.
+        self._pixmap_cache = collections.OrderedDict()
+
+        # Pixmap evicted from the cache, overwritten by the next conversion.
+        self._spare_pixmap = None
+
+        # Filename -> QPixmap, least recently used first.
+        self._file_cache = collections.OrderedDict()
+
+        # Type and cacheKey() of the QImage or QPixmap currently shown.
+        self._last_image_key = None
+
+        # (width, height) of the scene rect.
+        self._last_size = None
+
+        # Viewport size the scene rect was last fitted into.
+        self._last_fit_size = None
+
+        # Filenames being decoded by 'preload()'.
+        self._preloading = set()
+
+        # Filename passed to 'loadImageFromFile()' which is still being decoded.
+        self._show_when_loaded = None
+        self._imagePreloaded.connect(self._on_image_preloaded)
+
     def hasPixmap(self):
         """Returns whether or not the scene contains an image pixmap."""
         return self._pixmapHandle is not None
@@ -79,6 +219,8 @@ class QtImageViewer(QGraphicsView):
         if self.hasPixmap():
             self.scene.removeItem(self._pixmapHandle)
             self._pixmapHandle = None
+        self._last_image_key = None
+        self._last_size = None
 
     def pixmap(self) -> QPixmap:
         """Returns the scene's current image pixmap as a QPixmap, or else None if no image exists.
@@ -93,21 +235,88 @@ class QtImageViewer(QGraphicsView):
         Raises a RuntimeError if the input image has type other than QImage or QPixmap.
         :type image: QImage | QPixmap
         """
-        pixmap = image
-        if isinstance(image, QImage):
-            pixmap = QPixmap.fromImage(image)
-        assert isinstance(pixmap, QPixmap)
-        rectBefore = None
-        rectNew = QRectF(pixmap.rect())
+        # Supersedes a file which 'loadImageFromFile()' is still decoding
+        self._show_when_loaded = None
+        try:
+            to_pixmap = _IMG_TO_PIXMAP[type(image)]
+        except KeyError:
+            raise RuntimeError(
+                f"Expected QImage or QPixmap, got {type(image).__name__}"
+            ) from None
+        image_key = (type(image), image.cacheKey())
+        if image_key == self._last_image_key and self.hasPixmap():
+            # Already shown: Nothing to swap or repaint.
+            return
+        pixmap = to_pixmap(self, image)
         if self.hasPixmap():
-            rectBefore = self.sceneRect()
             self._pixmapHandle.setPixmap(pixmap)
         else:
             self._pixmapHandle = self.scene.addPixmap(pixmap)
-        if rectBefore != rectNew:
-            self.setSceneRect(QRectF(pixmap.rect()))  # Set scene size to image size.
+            self._pixmapHandle.setTransformationMode(self._transformation_mode())
+        self._last_image_key = image_key
+        # The scene keeps the size of the image, also if the pixmap has been downsampled.
+        new_size = (image.width(), image.height())
+        self._pixmapHandle.setScale(image.width() / max(pixmap.width(), 1))
+        if new_size != self._last_size:
+            self.setSceneRect(QRectF(0, 0, *new_size))  # Set scene size to image size.
+            self._last_size = new_size
+            self._last_fit_size = None
             self.updateViewer()
 
+    def _to_pixmap(self, image: QImage) -> QPixmap:
+        """Convert the QImage to a QPixmap.
+        Images shown before are taken from the cache instead of being converted again.
+        """
+        key = image.cacheKey()
+        viewport_size = self.viewport().size()
+        downsample = self.isVisible() and (
+            image.width() * image.height()
+            > _DOWNSAMPLE_AREA_RATIO * viewport_size.width() * viewport_size.height()
+        )
+        if downsample:
+            key = (key, viewport_size.width(), viewport_size.height())
+        pixmap = _lru_get(self._pixmap_cache, key)
+        if pixmap is None:
+            if downsample:
+                image = image.scaled(
+                    _PREVIEW_HEADROOM * viewport_size,
+                    Qt.KeepAspectRatio,
+                    Qt.FastTransformation,
+                )
+            # Recycle the pixmap evicted last: A video stream reuses the same surfaces.
+            spare, self._spare_pixmap = self._spare_pixmap, None
+            pixmap = _image_to_pixmap(image, spare)
+            evicted = _lru_put(self._pixmap_cache, key, pixmap, _PIXMAP_CACHE_SIZE)
+            if evicted is not None:
+                self._spare_pixmap = evicted
+        return pixmap
+
+    def preload(self, fileNames):
+        """Decode image files in the background.
+        A later loadImageFromFile(fileName) then shows the image without decoding it.
+        :type fileNames: list[str | pathlib.Path]
+        """
+        for fileName in fileNames:
+            filename = str(fileName)
+            if filename in self._preloading or filename in self._file_cache:
+                continue
+            self._preloading.add(filename)
+            QThreadPool.globalInstance().start(
+                _ImageLoader(filename, self._imagePreloaded)
+            )
+
+    def _on_image_preloaded(self, filename: str, image: QImage):
+        self._preloading.discard(filename)
+        show = filename == self._show_when_loaded
+        if show:
+            self._show_when_loaded = None
+        if image.isNull():
+            return
+        pixmap = _image_to_pixmap(image)
+        _lru_put(self._file_cache, filename, pixmap, _FILE_CACHE_SIZE)
+        if show:
+            self.setImage(pixmap)
+
     def loadImageFromFile(self, fileName: pathlib.Path = None):
         """Load an image from file.
         Without any arguments, loadImageFromFile() will popup a file dialog to choose the image file.
@@ -118,51 +327,88 @@ class QtImageViewer(QGraphicsView):
         if isinstance(fileName, str):
             fileName = pathlib.Path(fileName)
         assert isinstance(fileName, pathlib.Path)
+        self._show_when_loaded = None
+        pixmap = _lru_get(self._file_cache, str(fileName))
+        if pixmap is not None:
+            self.setImage(pixmap)
+            return
         if fileName.is_file():
-            image = QImage(str(fileName))
-            self.setImage(image)
+            # Decoded in the QThreadPool, the GUI stays responsive for large files.
+            self._show_when_loaded = str(fileName)
+            self.preload([fileName])
+
+    def _transformation_mode(self) -> Qt.TransformationMode:
+        return Qt.SmoothTransformation if self._smooth else Qt.FastTransformation
+
+    def _set_smooth(self, smooth: bool):
+        """Toggle between nearest neighbor and smooth pixmap scaling."""
+        if not smooth:
+            self._smooth_timer.stop()
+        if smooth == self._smooth:
+            return
+        self._smooth = smooth
+        self.setRenderHint(QPainter.SmoothPixmapTransform, smooth)
+        if self.hasPixmap():
+            self._pixmapHandle.setTransformationMode(self._transformation_mode())
 
     def updateViewer(self):
         """Show current zoom (if showing entire image, apply current aspect ratio mode)."""
-        if not self.hasPixmap():
+        if not self.hasPixmap() or self._is_zooming:
             return
-        if not self._is_zooming:
-            self.fitInView(self.sceneRect(), _ASPECT_RATIO_MODE)
+        viewport_size = self.viewport().size()
+        if viewport_size == self._last_fit_size or self.sceneRect().isEmpty():
+            return
+        self.fitInView(self.sceneRect(), _ASPECT_RATIO_MODE)
+        self._xform = self.transform()
+        self._last_fit_size = viewport_size
 
     def resizeEvent(self, event):
         """Maintain current zoom on resize."""
+        # Pixmaps downsampled for the previous viewport size.
+        for key in [key for key in self._pixmap_cache if isinstance(key, tuple)]:
+            del self._pixmap_cache[key]
         self.updateViewer()
 
+    def _emit_scene_pos(self, signal, event):
+        """Emit the scene position of the mouse event, if anybody listens."""
+        if self.receivers(signal) > 0:
+            signal.emit(self.mapToScene(event.pos()))
+
     def mousePressEvent(self, event):
         """Start mouse pan or zoom mode."""
-        scenePos = self.mapToScene(event.pos())
+        if event.button() not in _HANDLED_BUTTONS:
+            return QGraphicsView.mousePressEvent(self, event)
         if event.button() == Qt.LeftButton:
             if self.canPan:
+                self._set_smooth(False)
                 self.setDragMode(QGraphicsView.ScrollHandDrag)
-            self.leftMouseButtonPressed.emit(scenePos.x(), scenePos.y())
+            self._emit_scene_pos(self.leftMouseButtonPressed, event)
         QGraphicsView.mousePressEvent(self, event)
 
     def mouseReleaseEvent(self, event):
         """Stop mouse pan or zoom mode (apply zoom if valid)."""
         QGraphicsView.mouseReleaseEvent(self, event)
-        scenePos = self.mapToScene(event.pos())
+        if event.button() not in _HANDLED_BUTTONS:
+            return
         if event.button() == Qt.LeftButton:
             self.setDragMode(QGraphicsView.NoDrag)
-            self.leftMouseButtonReleased.emit(scenePos.x(), scenePos.y())
+            self._smooth_timer.start()
+            self._emit_scene_pos(self.leftMouseButtonReleased, event)
         elif event.button() == Qt.RightButton:
             self.setDragMode(QGraphicsView.NoDrag)
-            self.rightMouseButtonReleased.emit(scenePos.x(), scenePos.y())
+            self._emit_scene_pos(self.rightMouseButtonReleased, event)
 
     def mouseDoubleClickEvent(self, event):
         """Show entire image."""
-        scenePos = self.mapToScene(event.pos())
+        if event.button() not in _HANDLED_BUTTONS:
+            return QGraphicsView.mouseDoubleClickEvent(self, event)
         if event.button() == Qt.LeftButton:
-            self.leftMouseButtonDoubleClicked.emit(scenePos.x(), scenePos.y())
+            self._emit_scene_pos(self.leftMouseButtonDoubleClicked, event)
             if self.canZoom:
                 self._is_zooming = False
                 self.updateViewer()
         elif event.button() == Qt.RightButton:
-            self.rightMouseButtonDoubleClicked.emit(scenePos.x(), scenePos.y())
+            self._emit_scene_pos(self.rightMouseButtonDoubleClicked, event)
         QGraphicsView.mouseDoubleClickEvent(self, event)
 
     def wheelEvent(self, event):
@@ -172,17 +418,28 @@ class QtImageViewer(QGraphicsView):
         """
         if self.canZoom:
             self._is_zooming = True
+            self._last_fit_size = None
+            self._set_smooth(False)
 
-            zoom = _ZOOM_FACTOR if event.angleDelta().y() > 0 else 1 / _ZOOM_FACTOR
+            zoom = _ZOOMS[event.angleDelta().y() > 0]
 
-            self.scale(zoom, zoom)
+            # Successive scales compose: Many wheel events result in one setTransform().
+            self._pending_zoom *= zoom
+            self._zoom_timer.start()
 
         QGraphicsView.wheelEvent(self, event)
 
+    def _flush_zoom(self):
+        zoom = self._pending_zoom
+        self._pending_zoom = 1.0
+        self._xform.scale(zoom, zoom)
+        self.setTransform(self._xform)
+        self._smooth_timer.start()
+
 
 if __name__ == "__main__":
-    def handleLeftClick(x, y):
-        print(f"Clicked on image pixel (x={x:0.2f}, y={y:0.2f})")
+    def handleLeftClick(p):
+        print(f"Clicked on image pixel (x={p.x():0.2f}, y={p.y():0.2f})")
 
     # Create the application.
     app = QApplication(sys.argv)
@@ -191,13 +448,20 @@ if __name__ == "__main__":
     viewer = QtImageViewer()
     #  viewer.loadImageFromFile()  # Pops up file dialog.
 
-    images = []
-    for i in range(6):
-        filename_png = pathlib.Path(__file__).parent.parent / "images" / f"side{i}.png"
-        images.append(QImage(str(filename_png)))
+    filenames_png = [
+        pathlib.Path(__file__).parent.parent / "images" / f"side{i}.png"
+        for i in range(6)
+    ]
+
+    # Images are decoded on first use: The viewer decodes the next image
+    # in the background while the current one is shown.
+    next_filename = random.choice(filenames_png)
 
     def random_image():
-        viewer.setImage(random.choice(images))
+        global next_filename
+        viewer.loadImageFromFile(next_filename)
+        next_filename = random.choice(filenames_png)
+        viewer.preload([next_filename])
 
     timer = QTimer(app)
     timer.timeout.connect(random_image)